@@ -200,4 +200,49 @@ def get_tasks_args(parser):
                        action='store_true',
                        help='position-encoding-2d')
 
+    group.add_argument('--use-torch-compile',
+                       action='store_true',
+                       help='Compile each transformer layer with torch.compile '
+                       '(regional compilation).')
+
+    group.add_argument('--fused-lm-cross-entropy',
+                       action='store_true',
+                       help='Compute the lm cross entropy chunk by chunk from the '
+                       'hidden states, without materializing the logits.')
+
+    group.add_argument('--use-cuda-graph',
+                       action='store_true',
+                       help='Capture the transformer layers between the attention '
+                       'calls into CUDA graphs with torch.compile. Meant for '
+                       'fixed shape training.')
+
+    group.add_argument('--bf16-lm-cross-entropy',
+                       action='store_true',
+                       help='Keep the bf16 logits in the lm cross entropy and '
+                       'only accumulate the loss in fp32.')
+
+    group.add_argument('--use-bsh-layout',
+                       action='store_true',
+                       help='Compute the lm logits, labels and loss in [b, s] '
+                       'layout instead of transposing them.')
+
+    group.add_argument('--use-triton-logits',
+                       action='store_true',
+                       help='Compute the inference lm logits with a Triton '
+                       'kernel when triton is installed.')
+
+    group.add_argument('--async-checkpoint-copy',
+                       action='store_true',
+                       help='With --use-distributed-optimizer, copy the model '
+                       'weights to reused pinned host memory on a side stream '
+                       'while the optimizer file is written. Only used by the '
+                       'finetune save path, pretraining saves through '
+                       'Megatron-LM.')
+
+    group.add_argument('--mmap-load',
+                       action='store_true',
+                       help='Memory map the checkpoint files when loading '
+                       'instead of reading them fully into host memory '
+                       '(requires torch 2.1 or newer).')
+
     return parser
@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import inspect
 import os
 import random
 import sys
+import zipfile
+from functools import partial
 
 import numpy as np
 import torch
@@ -146,6 +149,35 @@ def fix_query_key_value_ordering(model, checkpoint_version):
                      ' checkpoint version {}'.format(checkpoint_version))
 
 
+def load_state_dict_mmap(checkpoint_name, weights_only=False):
+    """Load a checkpoint file memory mapped on the host.
+
+    The tensors are paged in from the file when they are first read, so
+    copying them into the model skips the extra host copy of a plain
+    torch.load. Megatron checkpoints pickle the arguments, hence
+    weights_only defaults to False.
+    """
+    return torch.load(checkpoint_name,
+                      map_location='cpu',
+                      mmap=True,
+                      weights_only=weights_only)
+
+
+def _check_mmap_load(checkpoint_names):
+    """Fail early and clearly when the checkpoint files can't be memory mapped."""
+    if 'mmap' not in inspect.signature(torch.load).parameters:
+        raise RuntimeError(
+            '--mmap-load requires torch 2.1 or newer, found torch {}'.format(
+                torch.__version__))
+    for checkpoint_name in checkpoint_names:
+        if os.path.isfile(checkpoint_name) and \
+                not zipfile.is_zipfile(checkpoint_name):
+            raise RuntimeError(
+                '--mmap-load requires checkpoints saved in the zipfile format '
+                'of torch 1.6 or newer, {} uses the legacy format'.format(
+                    checkpoint_name))
+
+
 def _load_base_checkpoint(load_dir, use_distributed_optimizer, rank0=False):
     """ Load the base state_dict from the given directory
 
@@ -189,13 +221,16 @@ def _load_base_checkpoint(load_dir, use_distributed_optimizer, rank0=False):
     model_checkpoint_name, optim_checkpoint_name = checkpoint_names
     # Load the checkpoint.
     args = get_args()
+    if getattr(args, 'mmap_load', False):
+        _check_mmap_load(checkpoint_names)
+        load_fn = load_state_dict_mmap
+    else:
+        load_fn = partial(torch.load, map_location='cpu')
     try:
-        model_state_dict = torch.load(model_checkpoint_name,
-                                      map_location='cpu')
+        model_state_dict = load_fn(model_checkpoint_name)
         if not args.no_load_optim:
             if use_distributed_optimizer:
-                optim_state_dict = torch.load(optim_checkpoint_name,
-                                              map_location='cpu')
+                optim_state_dict = load_fn(optim_checkpoint_name)
             else:
                 optim_state_dict = model_state_dict
         else:
@@ -363,6 +398,48 @@ def get_hf_checkpoint_dir(checkpoints_path, iteration, release=False):
     return os.path.join(checkpoints_path, directory)
 
 
+# Pinned host copies of the model weights, reused by every save.
+_PINNED_HOST_BUFFERS = {}
+
+
+def copy_state_dict_to_host_async(state_dict, copy_stream, prefix=()):
+    """Copy the CUDA tensors of a nested state dict to pinned host memory.
+
+    The copies are issued on copy_stream after it waits on the current
+    stream, so they overlap whatever the host does next. The caller must
+    synchronize copy_stream before reading or serializing the result and
+    before updating the parameters in place. The pinned buffers are kept
+    and reused by the next save, so the result is only valid until then.
+    """
+    copy_stream.wait_stream(torch.cuda.current_stream())
+
+    def _copy(value, key):
+        if isinstance(value, dict):
+            copied = type(value)(
+                (k, _copy(v, key + (k, ))) for k, v in value.items())
+            # Keep the version metadata load_state_dict relies on.
+            if hasattr(value, '_metadata'):
+                copied._metadata = value._metadata
+            return copied
+        if torch.is_tensor(value) and value.is_cuda:
+            value = value.detach()
+            host = _PINNED_HOST_BUFFERS.get(key)
+            if host is None or host.size() != value.size() or \
+                    host.dtype != value.dtype:
+                host = torch.empty(value.size(),
+                                   dtype=value.dtype,
+                                   pin_memory=True)
+                _PINNED_HOST_BUFFERS[key] = host
+            host.copy_(value, non_blocking=True)
+            # Temporaries of the state dict must outlive the copy.
+            value.record_stream(copy_stream)
+            return host
+        return value
+
+    with torch.cuda.stream(copy_stream):
+        return _copy(state_dict, prefix)
+
+
 def save_checkpoint(iteration, model, optimizer, opt_param_scheduler):
     """Save a model checkpoint."""
     args = get_args()
@@ -382,6 +459,16 @@ def save_checkpoint(iteration, model, optimizer, opt_param_scheduler):
                              iteration,
                              args.use_distributed_optimizer)
 
+    # With the distributed optimizer the model and the optimizer are saved
+    # to separate files, the model weights are copied to the host on a side
+    # stream while the optimizer file is written.
+    copy_stream = None
+    if getattr(args, 'async_checkpoint_copy', False) \
+            and args.transformer_type == 'megatron' \
+            and args.use_distributed_optimizer \
+            and torch.cuda.is_available():
+        copy_stream = torch.cuda.Stream()
+
     # Collect args, model, RNG.
     model_state_dict = {}
     if not torch.distributed.is_initialized() \
@@ -403,6 +490,12 @@ def save_checkpoint(iteration, model, optimizer, opt_param_scheduler):
         elif args.transformer_type == 'huggingface':
             model_state_dict['model'] = model[0].state_dict()
 
+        if copy_stream is not None:
+            for key in model_state_dict:
+                if key.startswith('model'):
+                    model_state_dict[key] = copy_state_dict_to_host_async(
+                        model_state_dict[key], copy_stream, prefix=(key, ))
+
         # RNG states.
         if not args.no_save_rng:
             model_state_dict['rng_state'] = rng_state
@@ -426,13 +519,16 @@ def save_checkpoint(iteration, model, optimizer, opt_param_scheduler):
     if args.transformer_type == 'megatron':
         # Save.
         if args.use_distributed_optimizer:
-            # Save model separate from optimizer.
-            if model_state_dict:
-                ensure_directory_exists(model_checkpoint_name)
-                torch.save(model_state_dict, model_checkpoint_name)
+            # Save model separate from optimizer. The optimizer file goes
+            # first, the model weights are still being copied meanwhile.
             if optim_state_dict:
                 ensure_directory_exists(optim_checkpoint_name)
                 torch.save(optim_state_dict, optim_checkpoint_name)
+            if copy_stream is not None:
+                copy_stream.synchronize()
+            if model_state_dict:
+                ensure_directory_exists(model_checkpoint_name)
+                torch.save(model_state_dict, model_checkpoint_name)
         else:
             # Save model and optimizer together.
             state_dict = {**model_state_dict, **optim_state_dict}
@@ -0,0 +1,126 @@
+# Copyright (c) 2023 Alibaba PAI and Nvidia Megatron-LM Team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import operator
+
+import torch
+
+# Registers the megatron:: custom ops used by the patterns below.
+import megatron_patch.ops.cross_entropy
+
+try:
+    from torch._inductor import config as inductor_config
+    from torch._inductor.custom_graph_pass import (CustomGraphPass,
+                                                   get_hash_for_files)
+    from torch._inductor.pattern_matcher import (CallFunction, Ignored,
+                                                 KeywordArg, Match,
+                                                 PatternMatcherPass,
+                                                 register_graph_pattern)
+except ImportError:
+    inductor_config = None
+
+_PATTERNS = None
+
+
+def _logits_ce_pattern(view_op):
+    """logits = view(hidden @ weight.T) feeding the cross entropy, only its loss being used."""
+    aten = torch.ops.aten
+    logits = CallFunction(
+        view_op,
+        CallFunction(aten.mm.default, KeywordArg('hidden'),
+                     CallFunction(aten.permute.default, KeywordArg('weight'),
+                                  Ignored())), Ignored())
+    return CallFunction(
+        operator.getitem,
+        CallFunction(torch.ops.megatron.vocab_parallel_cross_entropy.default,
+                     logits, KeywordArg('target'), Ignored()), 0)
+
+
+def _replace_logits_ce(match: Match, hidden, weight, target):
+    def repl(hidden, weight, target):
+        return torch.ops.megatron.fused_logits_ce.default(
+            hidden, weight, target)
+
+    match.replace_by_example(repl, [hidden, weight, target])
+
+
+def _build_patterns():
+    patterns = PatternMatcherPass()
+    # The cross entropy node must have the loss as its single user. When
+    # autograd needs the softmax it is saved for backward and nothing matches,
+    # so only graphs without backward (evaluation, inference) are rewritten.
+    for view_op in (torch.ops.aten.view.default,
+                    torch.ops.aten._unsafe_view.default):
+        register_graph_pattern(_logits_ce_pattern(view_op),
+                               pass_dict=patterns)(_replace_logits_ce)
+    return patterns
+
+
+if inductor_config is not None:
+
+    class _FusedCEPass(CustomGraphPass):
+        """The fused logits + cross entropy rewrite, run after an optional previous pass."""
+        def __init__(self, previous_pass=None):
+            self.previous_pass = previous_pass
+
+        def __call__(self, graph):
+            global _PATTERNS
+            if self.previous_pass is not None:
+                self.previous_pass(graph)
+            if _PATTERNS is None:
+                _PATTERNS = _build_patterns()
+            _PATTERNS.apply(graph)
+
+        def uuid(self):
+            # Keys the FX graph cache, it changes with the pattern definitions.
+            previous_uuid = None
+            if self.previous_pass is not None:
+                previous_uuid = getattr(self.previous_pass, 'uuid',
+                                        lambda: None)()
+                if previous_uuid is None:
+                    # An opaque previous pass can't be keyed, skip the cache.
+                    return None
+            return get_hash_for_files((__file__, )), previous_uuid
+
+
+def compile_with_fused_ce(model, **compile_kwargs):
+    """
+    Compiles the whole model with the fused logits + cross entropy rewrite.
+
+    The eager sequence mm(hidden, weight.T) -> view -> megatron::vocab_parallel_cross_entropy
+    is replaced by megatron::fused_logits_ce, which never materializes the logits. The
+    sequence only appears in a graph when the whole model, including the logits and the
+    loss, is compiled, so the pass is scoped to this compilation through the Inductor
+    options instead of the global config. A post grad pass already configured keeps
+    running, before this one.
+
+    Args:
+        model (torch.nn.Module): The model to compile, called with labels.
+        **compile_kwargs: Forwarded to torch.compile, except for mode, which Inductor
+            options can't be combined with.
+
+    Returns:
+        The compiled model, compiled without the rewrite if this torch lacks Inductor
+        custom graph passes or torch.library.custom_op.
+    """
+    if inductor_config is None or \
+            not hasattr(torch.ops.megatron, 'fused_logits_ce'):
+        return torch.compile(model, **compile_kwargs)
+
+    options = dict(compile_kwargs.pop('options', None) or {})
+    previous_pass = options.get('post_grad_custom_post_pass',
+                                inductor_config.post_grad_custom_post_pass)
+    options['post_grad_custom_post_pass'] = _FusedCEPass(previous_pass)
+    return torch.compile(model, options=options, **compile_kwargs)
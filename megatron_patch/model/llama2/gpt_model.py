@@ -12,21 +12,87 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import types
+
 import torch
 
 from megatron import get_args
-from megatron.core import tensor_parallel
+from megatron import print_rank_0
+from megatron.core import mpu
 from megatron.model.enums import AttnMaskType
 from megatron.model.module import MegatronModule
 from megatron.model.utils import init_method_normal
 from megatron.model.utils import scaled_init_method_normal
 
+from megatron_patch.ops.cross_entropy import \
+    fused_vocab_parallel_logits_cross_entropy
+from megatron_patch.ops.cross_entropy import vocab_parallel_cross_entropy
+
 from .language_model import get_language_model
 from .language_model import parallel_lm_logits
 
 
-def post_language_model_processing(lm_output, labels, logit_weights,
-                                   parallel_output, fp16_lm_cross_entropy):
+class TransposeBuffer(object):
+    """
+    Reusable storage for the [b s] <=> [s b] copies of post_language_model_processing.
+
+    The transposed copy is written into a view of a buffer that only grows, so it does
+    not go through the caching allocator at every step and keeps a stable address, as
+    CUDA graph capture requires. The returned tensor is overwritten by the next call.
+    """
+    def __init__(self):
+        self._buffer = None
+
+    def transpose(self, tensor, copy_stream=None):
+        """
+        Copies a 2-D tensor into the buffer, transposed.
+
+        Args:
+            tensor: The tensor to transpose, of shape [x, y].
+            copy_stream: The CUDA stream to issue the copy on, so it overlaps with the work
+                enqueued next on the current stream. The caller must make the current stream
+                wait for it before reading the result. Defaults to None.
+
+        Returns:
+            The contiguous transposed tensor of shape [y, x].
+        """
+        if tensor.requires_grad:
+            # Autograd may keep it alive across micro batches, it can't share
+            # storage with the next one.
+            return tensor.transpose(0, 1).contiguous()
+
+        numel = tensor.numel()
+        if self._buffer is None or self._buffer.numel() < numel or \
+                self._buffer.dtype != tensor.dtype or \
+                self._buffer.device != tensor.device:
+            self._buffer = torch.empty(numel,
+                                       dtype=tensor.dtype,
+                                       device=tensor.device)
+        output = self._buffer[:numel].view(tensor.size(1), tensor.size(0))
+
+        if copy_stream is None or not tensor.is_cuda:
+            output.copy_(tensor.transpose(0, 1))
+            return output
+
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            output.copy_(tensor.transpose(0, 1), non_blocking=True)
+        # Keep the allocator from reusing the input before the copy is done.
+        tensor.record_stream(copy_stream)
+        return output
+
+
+def post_language_model_processing(lm_output,
+                                   labels,
+                                   logit_weights,
+                                   parallel_output,
+                                   fp16_lm_cross_entropy,
+                                   bf16_lm_cross_entropy=False,
+                                   fused_lm_cross_entropy=False,
+                                   bsh_layout=False,
+                                   copy_stream=None,
+                                   labels_buffer=None,
+                                   loss_buffer=None):
     """
     This function is used for post-processing the output of the language model.
 
@@ -36,33 +102,201 @@ def post_language_model_processing(lm_output, labels, logit_weights,
         logit_weights: The logit weights tensor of shape [parallel_output_size, hidden_size].
         parallel_output: The parallel output tensor of shape [parallel_output_size, hidden_size].
         fp16_lm_cross_entropy: A flag indicating whether to use FP16 for the cross-entropy calculation.
+        bf16_lm_cross_entropy: A flag indicating whether to keep BF16 logits in the cross-entropy calculation, accumulating in FP32.
+        fused_lm_cross_entropy: A flag indicating whether to compute the cross-entropy without materializing the logits.
+        bsh_layout: A flag indicating whether to compute the logits in [batch_size, sequence_length] layout, so neither the labels nor the loss are transposed.
+        copy_stream: The CUDA stream the labels are transposed on while the logits are computed.
+        labels_buffer: The TransposeBuffer holding the transposed labels.
+        loss_buffer: The TransposeBuffer holding the transposed loss when autograd does not track it.
+            When None, the loss is returned in fresh storage.
 
     Returns:
-        If the labels are None, the function returns the output tensor as is, transposed to shape [batch_size, sequence_length, hidden_size].
+        If the labels are None, the function returns the output tensor of shape [batch_size, sequence_length, hidden_size], computed directly in that layout.
         If the labels are provided, the function calculates the cross-entropy loss and returns the loss tensor transposed to shape [batch_size, sequence_length].
+        A loss held in loss_buffer is only valid until the next call.
 
     """
+    if labels_buffer is None:
+        labels_buffer = TransposeBuffer()
 
-    # Output. Format [s b h]
-    output = parallel_lm_logits(lm_output, logit_weights, parallel_output)
+    if labels is not None and fused_lm_cross_entropy and parallel_output:
+        args = get_args()
+        # [b s] => [s b]
+        labels = labels_buffer.transpose(labels)
+        loss = fused_vocab_parallel_logits_cross_entropy(
+            lm_output,
+            logit_weights,
+            labels,
+            args.sequence_parallel,
+            gradient_accumulation_fusion=args.gradient_accumulation_fusion)
+        # [s b] => [b, s]
+        if loss_buffer is None:
+            return loss.transpose(0, 1).contiguous()
+        return loss_buffer.transpose(loss)
 
-    if labels is None:
-        # [s b h] => [b s h]
-        return output.transpose(0, 1).contiguous()
+    if labels is None or bsh_layout:
+        # Output. Format [b s h]
+        output = parallel_lm_logits(lm_output,
+                                    logit_weights,
+                                    parallel_output,
+                                    return_layout='bsh')
+        if labels is None:
+            return output
     else:
         # [b s] => [s b]
-        labels = labels.transpose(0, 1).contiguous()
-        if fp16_lm_cross_entropy:
-            assert output.dtype == torch.half
-            loss = tensor_parallel.vocab_parallel_cross_entropy(
-                output, labels)
-        else:
-            loss = tensor_parallel.vocab_parallel_cross_entropy(
-                output.float(), labels)
+        labels = labels_buffer.transpose(labels, copy_stream)
+        # Output. Format [s b h]
+        output = parallel_lm_logits(lm_output, logit_weights, parallel_output)
+        if copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(copy_stream)
 
+    if fp16_lm_cross_entropy:
+        assert output.dtype == torch.half
+    if bf16_lm_cross_entropy:
+        assert output.dtype == torch.bfloat16
+    loss = vocab_parallel_cross_entropy(
+        output,
+        labels,
+        keep_logits_dtype=fp16_lm_cross_entropy or bf16_lm_cross_entropy)
+
+    if not bsh_layout:
         # [s b] => [b, s]
-        loss = loss.transpose(0, 1).contiguous()
-        return loss
+        if loss_buffer is None:
+            loss = loss.transpose(0, 1).contiguous()
+        else:
+            loss = loss_buffer.transpose(loss)
+    return loss
+
+
+# Grad mode and the training flag are guarded on, see compile_transformer_layers.
+_COMPILE_VARIANTS_PER_LAYER = 3
+
+
+def compile_transformer_layers(language_model, mode='default'):
+    """
+    Compiles every transformer layer of the language model with torch.compile.
+
+    Only the forward of the repeated layers is compiled (regional compilation), so the
+    graphs stay small and the state dict keys are left untouched. The logits projection
+    and the vocab parallel cross entropy keep running in eager mode.
+
+    With mode='reduce-overhead' the attention is kept out of the graphs, so the pieces
+    between two attention calls are captured into CUDA graphs and replayed while the
+    attention itself runs eagerly.
+
+    Args:
+        language_model: The TransformerLanguageModel returned by get_language_model.
+        mode (str, optional): The torch.compile mode. Defaults to 'default'.
+    """
+    transformers = [
+        transformer
+        for transformer in (language_model.encoder, language_model.decoder)
+        if transformer is not None
+    ]
+
+    # All the layers share the code object of their forward, so its cache holds
+    # one entry per layer and per guarded variant: training with grad, training
+    # without grad (the first pass of full activation recompute) and evaluation.
+    num_entries = _COMPILE_VARIANTS_PER_LAYER * sum(
+        len(transformer.layers) for transformer in transformers)
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, num_entries)
+    if hasattr(torch._dynamo.config, 'accumulated_cache_size_limit'):
+        torch._dynamo.config.accumulated_cache_size_limit = max(
+            torch._dynamo.config.accumulated_cache_size_limit, num_entries)
+
+    for transformer in transformers:
+        for layer in transformer.layers:
+            if mode == 'reduce-overhead' and hasattr(layer, 'self_attention'):
+                layer.self_attention.forward = torch._dynamo.disable(
+                    layer.self_attention.forward)
+            # fullgraph is not requested since flash attention and
+            # make_viewless_tensor still break the graph.
+            layer.forward = torch.compile(layer.forward,
+                                          dynamic=False,
+                                          mode=mode)
+
+
+def _forward_post_tied(self,
+                       input_ids,
+                       position_ids=None,
+                       attention_mask=None,
+                       labels=None,
+                       inference_params=None):
+    """GPTModel forward of the last stage, logits from the word embeddings."""
+    lm_output = self.language_model(input_ids,
+                                    position_ids,
+                                    attention_mask,
+                                    inference_params=inference_params)
+    return post_language_model_processing(
+        lm_output, labels, self._tied_weight_fn(), self.parallel_output,
+        self.fp16_lm_cross_entropy, self.bf16_lm_cross_entropy,
+        self.fused_lm_cross_entropy, self.bsh_layout, self._copy_stream,
+        self._labels_sb_buf, self._loss_bs_buf)
+
+
+def _forward_post_untied(self,
+                         input_ids,
+                         position_ids=None,
+                         attention_mask=None,
+                         labels=None,
+                         inference_params=None):
+    """GPTModel forward of the last stage, logits from the output layer."""
+    lm_output = self.language_model(input_ids,
+                                    position_ids,
+                                    attention_mask,
+                                    inference_params=inference_params)
+    return post_language_model_processing(
+        lm_output, labels, self.language_model.output_layer.weight,
+        self.parallel_output, self.fp16_lm_cross_entropy,
+        self.bf16_lm_cross_entropy, self.fused_lm_cross_entropy,
+        self.bsh_layout, self._copy_stream, self._labels_sb_buf,
+        self._loss_bs_buf)
+
+
+def _forward_no_post(self,
+                     input_ids,
+                     position_ids=None,
+                     attention_mask=None,
+                     labels=None,
+                     inference_params=None):
+    """GPTModel forward of the other stages, returns the hidden states."""
+    return self.language_model(input_ids,
+                               position_ids,
+                               attention_mask,
+                               inference_params=inference_params)
+
+
+def _mark_cudagraph_step(forward):
+    """
+    Wraps a forward so every inference call starts a new CUDA graph step.
+
+    Without a backward pass the cudagraph trees cannot tell where one step
+    ends, so the step is marked explicitly when grad is disabled. Training
+    steps are left to the automatic detection, since with pipelining several
+    forwards run before their backwards and their outputs must stay alive.
+
+    Args:
+        forward (callable): One of the stage specialized forwards.
+
+    Returns:
+        callable: The wrapped forward.
+    """
+    def _forward(self, *args, **kwargs):
+        if not torch.is_grad_enabled():
+            torch.compiler.cudagraph_mark_step_begin()
+        return forward(self, *args, **kwargs)
+
+    return _forward
+
+
+def _select_forward(model):
+    """Returns the forward implementation matching the stage of the GPTModel."""
+    if not model.post_process:
+        return _forward_no_post
+    if model.untie_embeddings_and_output_weights:
+        return _forward_post_untied
+    return _forward_post_tied
 
 
 class GPTModel(MegatronModule):
@@ -89,9 +323,35 @@ class GPTModel(MegatronModule):
         self.pre_process = pre_process
         self.post_process = post_process
         self.fp16_lm_cross_entropy = args.fp16_lm_cross_entropy
+        self.bf16_lm_cross_entropy = args.bf16_lm_cross_entropy
+        self.fused_lm_cross_entropy = args.fused_lm_cross_entropy
+        # Sequence parallel logits are split along the sequence dimension
+        # and can't be produced in [b s h] without a transpose.
+        self.bsh_layout = args.use_bsh_layout and not args.sequence_parallel
+        # Side stream and reusable storage for the labels and loss transposes.
+        # The loss is only buffered for CUDA graphs, which need its address
+        # to be stable, since a buffered loss is overwritten by the next call.
+        self._copy_stream = torch.cuda.Stream() \
+            if post_process and torch.cuda.is_available() else None
+        self._labels_sb_buf = TransposeBuffer()
+        self._loss_bs_buf = TransposeBuffer() if args.use_cuda_graph else None
         self.untie_embeddings_and_output_weights =\
             args.untie_embeddings_and_output_weights
 
+        # The vocab is padded when the tokenizer is built and the checkpoints
+        # are saved with that size, so only validate the shards here.
+        self.padded_vocab_size = args.padded_vocab_size
+        world_size = mpu.get_tensor_model_parallel_world_size()
+        assert self.padded_vocab_size % world_size == 0, \
+            'padded vocab size {} is not divisible by the tensor model ' \
+            'parallel size {}, adjust --extra-vocab-size'.format(
+                self.padded_vocab_size, world_size)
+        if self.padded_vocab_size // world_size % 128 != 0:
+            print_rank_0('> WARNING: vocab shard size {} is not a multiple of '
+                         '128, the logits projection GEMM gets partial tiles, '
+                         'adjust --extra-vocab-size'.format(
+                             self.padded_vocab_size // world_size))
+
         self.language_model, self._language_model_key = get_language_model(
             num_tokentypes=num_tokentypes,
             add_pooler=False,
@@ -104,6 +364,30 @@ class GPTModel(MegatronModule):
 
         if not args.untie_embeddings_and_output_weights:
             self.initialize_word_embeddings(init_method_normal)
+            if self.pre_process or self.post_process:
+                # Resolve once which module holds the tied weight instead of
+                # going through word_embeddings_weight() at every step. The
+                # weight itself is read at call time, so reloaded parameters
+                # are picked up.
+                if self.pre_process:
+                    tied_embedding = \
+                        self.language_model.embedding.word_embeddings
+                else:
+                    tied_embedding = self.word_embeddings
+                self._tied_weight_fn = lambda: tied_embedding.weight
+
+        # post_process and the weight tying never change, bind the matching
+        # forward once instead of branching on them at every step.
+        forward = _select_forward(self)
+        if args.use_cuda_graph:
+            forward = _mark_cudagraph_step(forward)
+        self.forward = types.MethodType(forward, self)
+
+        if args.use_cuda_graph:
+            compile_transformer_layers(self.language_model,
+                                       mode='reduce-overhead')
+        elif args.use_torch_compile:
+            compile_transformer_layers(self.language_model)
 
     def set_input_tensor(self, input_tensor):
         """See megatron.model.transformer.set_input_tensor()"""
@@ -127,21 +411,13 @@ class GPTModel(MegatronModule):
 
         Returns:
             Tensor: Output of the language model.
-        """
 
-        lm_output = self.language_model(input_ids,
-                                        position_ids,
-                                        attention_mask,
-                                        inference_params=inference_params)
-
-        if self.post_process:
-            return post_language_model_processing(
-                lm_output, labels, self.language_model.output_layer.weight
-                if self.untie_embeddings_and_output_weights else
-                self.word_embeddings_weight(), self.parallel_output,
-                self.fp16_lm_cross_entropy)
-        else:
-            return lm_output
+        Note:
+            __init__ binds the specialized forward of the stage on the instance, this
+            method only serves calls made through the class.
+        """
+        return _select_forward(self)(self, input_ids, position_ids,
+                                     attention_mask, labels, inference_params)
 
     def state_dict_for_save_checkpoint(self, prefix='', keep_vars=False):
         """
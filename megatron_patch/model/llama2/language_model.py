@@ -23,13 +23,17 @@ from megatron.model.utils import get_linear_layer
 from megatron.model.utils import init_method_normal
 from megatron.model.utils import scaled_init_method_normal
 
+from megatron_patch.ops.triton_logits import triton_lm_logits
+from megatron_patch.ops.triton_logits import use_triton_lm_logits
+
 from .transformer import ParallelTransformer
 
 
 def parallel_lm_logits(input_,
                        word_embeddings_weight,
                        parallel_output,
-                       bias=None):
+                       bias=None,
+                       return_layout='sbh'):
     """Calculates the logits of a language model using word embedding weights.
 
     Args:
@@ -37,12 +41,22 @@ def parallel_lm_logits(input_,
         word_embeddings_weight (torch.Tensor): The word embedding weights.
         parallel_output (bool): Flag to indicate whether to return parallel logits.
         bias (torch.Tensor, optional): The bias tensor. Defaults to None.
+        return_layout (str, optional): The layout of the logits, 'sbh' or 'bsh'. Defaults to 'sbh'.
 
     Returns:
         torch.Tensor: The calculated logits.
 
     """
     args = get_args()
+    # For [b s h] logits transpose the hidden states rather than the logits,
+    # unless they are split along the sequence dimension.
+    transpose_output = False
+    if return_layout == 'bsh':
+        if args.sequence_parallel:
+            transpose_output = True
+        else:
+            input_ = input_.transpose(0, 1).contiguous()
+
     # Parallel logits.
     if args.async_tensor_model_parallel_allreduce or\
             args.sequence_parallel:
@@ -56,21 +70,31 @@ def parallel_lm_logits(input_,
         async_grad_allreduce = False
 
     # Matrix multiply.
-    logits_parallel = \
-        tensor_parallel.linear_with_grad_accumulation_and_async_allreduce(
-            input=input_parallel,
-            weight=word_embeddings_weight,
-            bias=bias,
-            gradient_accumulation_fusion=args.gradient_accumulation_fusion,
-            async_grad_allreduce=async_grad_allreduce,
-            sequence_parallel_enabled=args.sequence_parallel)
+    if args.use_triton_logits and not args.sequence_parallel and \
+            use_triton_lm_logits(input_parallel, word_embeddings_weight, bias):
+        logits_parallel = triton_lm_logits(input_parallel,
+                                           word_embeddings_weight)
+    else:
+        logits_parallel = \
+            tensor_parallel.linear_with_grad_accumulation_and_async_allreduce(
+                input=input_parallel,
+                weight=word_embeddings_weight,
+                bias=bias,
+                gradient_accumulation_fusion=args.gradient_accumulation_fusion,
+                async_grad_allreduce=async_grad_allreduce,
+                sequence_parallel_enabled=args.sequence_parallel)
     # Gather if needed.
 
     if parallel_output:
-        return logits_parallel
+        output = logits_parallel
+    else:
+        output = tensor_parallel.gather_from_tensor_model_parallel_region(
+            logits_parallel)
+
+    if transpose_output:
+        output = output.transpose(0, 1)
 
-    return tensor_parallel.gather_from_tensor_model_parallel_region(
-        logits_parallel)
+    return output
 
 
 def get_language_model(num_tokentypes,
@@ -0,0 +1,400 @@
+# Copyright (c) 2023 Alibaba PAI and Nvidia Megatron-LM Team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Tuple
+
+import torch
+
+from megatron.core import mpu, tensor_parallel
+from megatron.core.tensor_parallel.utils import VocabUtility
+
+try:
+    from torch.library import custom_op
+except ImportError:
+    custom_op = None
+
+try:
+    import fused_weight_gradient_mlp_cuda
+    _grad_accum_fusion_available = True
+except ImportError:
+    _grad_accum_fusion_available = False
+
+
+def _vocab_parallel_cross_entropy_forward(vocab_parallel_logits, target,
+                                          keep_logits_dtype):
+
+    # Maximum value along vocab dimension across all GPUs.
+    logits_max = torch.max(vocab_parallel_logits, dim=-1)[0]
+    torch.distributed.all_reduce(
+        logits_max,
+        op=torch.distributed.ReduceOp.MAX,
+        group=mpu.get_tensor_model_parallel_group())
+
+    # Get the partition's vocab indecies
+    partition_vocab_size = vocab_parallel_logits.size()[-1]
+    rank = mpu.get_tensor_model_parallel_rank()
+    world_size = mpu.get_tensor_model_parallel_world_size()
+    vocab_start_index, vocab_end_index = \
+        VocabUtility.vocab_range_from_per_partition_vocab_size(
+            partition_vocab_size, rank, world_size)
+
+    # Create a mask of valid vocab ids (1 means it needs to be masked).
+    target_mask = (target < vocab_start_index) | (target >= vocab_end_index)
+    masked_target = target.clone() - vocab_start_index
+    masked_target[target_mask] = 0
+
+    # Get predicted-logits = logits[target].
+    # For Simplicity, we convert logits to a 2-D tensor with size
+    # [*, partition-vocab-size] and target to a 1-D tensor of size [*].
+    # The predicted logits are gathered before the maximum is subtracted and
+    # shifted in fp32, so they are not rounded to the dtype of the logits.
+    logits_2d = vocab_parallel_logits.view(-1, partition_vocab_size)
+    masked_target_1d = masked_target.view(-1)
+    arange_1d = torch.arange(start=0,
+                             end=logits_2d.size()[0],
+                             device=logits_2d.device)
+    predicted_logits_1d = logits_2d[arange_1d, masked_target_1d].float() - \
+        logits_max.view(-1).float()
+    predicted_logits = predicted_logits_1d.view_as(target)
+    predicted_logits[target_mask] = 0.0
+    # All reduce is needed to get the chunks from other GPUs.
+    torch.distributed.all_reduce(
+        predicted_logits,
+        op=torch.distributed.ReduceOp.SUM,
+        group=mpu.get_tensor_model_parallel_group())
+
+    # Subtracting the fp32 maximum promotes the result to fp32, so the
+    # upcast of the logits is fused into the subtraction instead of
+    # materializing a separate fp32 copy of the logits. With
+    # keep_logits_dtype only the softmax stays in the dtype of the logits.
+    if not keep_logits_dtype:
+        logits_max = logits_max.float()
+    exp_logits = vocab_parallel_logits - logits_max.unsqueeze(dim=-1)
+
+    # Sum of exponential of logits along vocab dimension across all GPUs.
+    # The sum is always accumulated in fp32.
+    torch.exp(exp_logits, out=exp_logits)
+    sum_exp_logits = exp_logits.sum(dim=-1, dtype=torch.float32)
+    torch.distributed.all_reduce(
+        sum_exp_logits,
+        op=torch.distributed.ReduceOp.SUM,
+        group=mpu.get_tensor_model_parallel_group())
+
+    # Loss = log(sum(exp(logits))) - predicted-logit.
+    loss = torch.log(sum_exp_logits) - predicted_logits
+
+    # Softmax, target-mask and masked-target are kept for backward pass.
+    exp_logits.div_(sum_exp_logits.unsqueeze(dim=-1))
+
+    return loss, exp_logits, target_mask, masked_target_1d
+
+
+def _vocab_parallel_cross_entropy_backward(grad_output, softmax, target_mask,
+                                           masked_target_1d, input_dtype):
+
+    # All the inputs have softmax as thier gradient.
+    grad_input = softmax
+    # For simplicity, work with the 2D gradient.
+    partition_vocab_size = softmax.size()[-1]
+    grad_2d = grad_input.view(-1, partition_vocab_size)
+
+    # Add the gradient from matching classes.
+    arange_1d = torch.arange(start=0,
+                             end=grad_2d.size()[0],
+                             device=grad_2d.device)
+    grad_2d[arange_1d, masked_target_1d] -= (
+        1.0 - target_mask.view(-1).to(grad_2d.dtype))
+
+    # Finally elementwise multiplication with the output gradients.
+    grad_input.mul_(grad_output.unsqueeze(dim=-1))
+
+    return grad_input.to(input_dtype)
+
+
+class _VocabParallelCrossEntropy(torch.autograd.Function):
+    """Vocab parallel cross entropy with fp32 accumulation."""
+
+    @staticmethod
+    def forward(ctx, vocab_parallel_logits, target, keep_logits_dtype):
+        loss, softmax, target_mask, masked_target_1d = \
+            _vocab_parallel_cross_entropy_forward(vocab_parallel_logits,
+                                                  target, keep_logits_dtype)
+        ctx.input_dtype = vocab_parallel_logits.dtype
+        ctx.save_for_backward(softmax, target_mask, masked_target_1d)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        softmax, target_mask, masked_target_1d = ctx.saved_tensors
+        grad_input = _vocab_parallel_cross_entropy_backward(
+            grad_output, softmax, target_mask, masked_target_1d,
+            ctx.input_dtype)
+        return grad_input, None, None
+
+
+if custom_op is not None:
+    # Registered as a custom op, torch.compile treats the cross entropy and its
+    # collectives as a single opaque node instead of breaking the graph.
+    @custom_op('megatron::vocab_parallel_cross_entropy', mutates_args=())
+    def _vocab_parallel_cross_entropy_op(
+        vocab_parallel_logits: torch.Tensor, target: torch.Tensor,
+        keep_logits_dtype: bool
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        return _vocab_parallel_cross_entropy_forward(vocab_parallel_logits,
+                                                     target, keep_logits_dtype)
+
+    @_vocab_parallel_cross_entropy_op.register_fake
+    def _(vocab_parallel_logits, target, keep_logits_dtype):
+        softmax_dtype = vocab_parallel_logits.dtype \
+            if keep_logits_dtype else torch.float32
+        loss = target.new_empty(target.shape, dtype=torch.float32)
+        softmax = vocab_parallel_logits.new_empty(vocab_parallel_logits.shape,
+                                                  dtype=softmax_dtype)
+        target_mask = target.new_empty(target.shape, dtype=torch.bool)
+        masked_target_1d = target.new_empty(target.numel())
+        return loss, softmax, target_mask, masked_target_1d
+
+    def _vocab_parallel_cross_entropy_setup_context(ctx, inputs, output):
+        vocab_parallel_logits, _, _ = inputs
+        _, softmax, target_mask, masked_target_1d = output
+        ctx.input_dtype = vocab_parallel_logits.dtype
+        ctx.save_for_backward(softmax, target_mask, masked_target_1d)
+
+    def _vocab_parallel_cross_entropy_op_backward(ctx, grad_output, *_):
+        softmax, target_mask, masked_target_1d = ctx.saved_tensors
+        grad_input = _vocab_parallel_cross_entropy_backward(
+            grad_output, softmax, target_mask, masked_target_1d,
+            ctx.input_dtype)
+        return grad_input, None, None
+
+    _vocab_parallel_cross_entropy_op.register_autograd(
+        _vocab_parallel_cross_entropy_op_backward,
+        setup_context=_vocab_parallel_cross_entropy_setup_context)
+
+
+def vocab_parallel_cross_entropy(vocab_parallel_logits,
+                                 target,
+                                 keep_logits_dtype=False):
+    """
+    Performs cross entropy loss when logits are split across tensor parallel ranks.
+
+    By default the softmax is computed in fp32 whatever the dtype of the logits,
+    without an explicit fp32 copy of the logits. With keep_logits_dtype the softmax
+    stays in the dtype of the logits and only the sum of exponentials and the loss
+    are accumulated in fp32.
+
+    When torch.library.custom_op is available this dispatches to the
+    megatron::vocab_parallel_cross_entropy op, so torch.compile can trace around it.
+
+    Args:
+        vocab_parallel_logits (torch.Tensor): The logits split across tensor parallel ranks,
+            of shape [sequence_length, batch_size, vocab_size/num_parallel_ranks].
+        target (torch.Tensor): The contiguous target tensor of shape [sequence_length, batch_size].
+        keep_logits_dtype (bool, optional): Whether to keep the softmax in the dtype of the logits. Defaults to False.
+
+    Returns:
+        torch.Tensor: The fp32 loss tensor of shape [sequence_length, batch_size].
+    """
+    if custom_op is not None:
+        return torch.ops.megatron.vocab_parallel_cross_entropy(
+            vocab_parallel_logits, target, keep_logits_dtype)[0]
+    return _VocabParallelCrossEntropy.apply(vocab_parallel_logits, target,
+                                            keep_logits_dtype)
+
+
+def _fused_logits_cross_entropy_forward(hidden, weight, target, chunk_size):
+
+    hidden_2d = hidden.reshape(-1, hidden.size()[-1])
+    target_1d = target.view(-1)
+    num_tokens = hidden_2d.size()[0]
+
+    # Get the partition's vocab indecies
+    partition_vocab_size = weight.size()[0]
+    rank = mpu.get_tensor_model_parallel_rank()
+    world_size = mpu.get_tensor_model_parallel_world_size()
+    vocab_start_index, vocab_end_index = \
+        VocabUtility.vocab_range_from_per_partition_vocab_size(
+            partition_vocab_size, rank, world_size)
+
+    # Create a mask of valid vocab ids (1 means it needs to be masked).
+    target_mask = (target_1d < vocab_start_index) | \
+        (target_1d >= vocab_end_index)
+    masked_target_1d = target_1d.clone() - vocab_start_index
+    masked_target_1d[target_mask] = 0
+
+    # Only a [chunk, partition-vocab-size] block of logits is alive at a
+    # time, we keep the partition's logsumexp and predicted logit per token.
+    lse = torch.empty(num_tokens, dtype=torch.float32, device=hidden_2d.device)
+    predicted_logits = torch.empty_like(lse)
+    for start in range(0, num_tokens, chunk_size):
+        end = min(start + chunk_size, num_tokens)
+        logits = torch.matmul(hidden_2d[start:end], weight.t()).float()
+        lse[start:end] = torch.logsumexp(logits, dim=-1)
+        predicted_logits[start:end] = logits.gather(
+            1, masked_target_1d[start:end].unsqueeze(1)).squeeze(1)
+    predicted_logits[target_mask] = 0.0
+
+    # Combine the partition's logsumexp across all GPUs.
+    lse_max = lse.clone()
+    torch.distributed.all_reduce(
+        lse_max,
+        op=torch.distributed.ReduceOp.MAX,
+        group=mpu.get_tensor_model_parallel_group())
+    sum_exp = torch.exp(lse - lse_max)
+    torch.distributed.all_reduce(
+        sum_exp,
+        op=torch.distributed.ReduceOp.SUM,
+        group=mpu.get_tensor_model_parallel_group())
+    lse = torch.log(sum_exp) + lse_max
+    torch.distributed.all_reduce(
+        predicted_logits,
+        op=torch.distributed.ReduceOp.SUM,
+        group=mpu.get_tensor_model_parallel_group())
+
+    loss = lse - predicted_logits
+
+    return loss.view_as(target), lse, target_mask, masked_target_1d
+
+
+class _FusedVocabParallelLogitsCrossEntropy(torch.autograd.Function):
+    """Logits projection and vocab parallel cross entropy, chunked over the tokens."""
+
+    @staticmethod
+    def forward(ctx, hidden, weight, target, chunk_size,
+                gradient_accumulation_fusion):
+        loss, lse, target_mask, masked_target_1d = \
+            _fused_logits_cross_entropy_forward(hidden, weight, target,
+                                                chunk_size)
+        ctx.chunk_size = chunk_size
+        ctx.gradient_accumulation_fusion = gradient_accumulation_fusion
+        ctx.save_for_backward(hidden, weight, lse, target_mask,
+                              masked_target_1d)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        # Retreive tensors from the forward path.
+        hidden, weight, lse, target_mask, masked_target_1d = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+
+        hidden_2d = hidden.reshape(-1, hidden.size()[-1])
+        grad_output_1d = grad_output.contiguous().view(-1)
+        num_tokens = hidden_2d.size()[0]
+
+        grad_hidden = torch.empty_like(hidden_2d)
+        # When the weight has a main_grad, the gradient is accumulated straight
+        # into it, as the Megatron linear does, instead of going through a
+        # transient fp32 copy of the weight rounded back to its dtype.
+        wgrad_gemm_accum = None
+        if ctx.gradient_accumulation_fusion:
+            if weight.main_grad.dtype == torch.float32:
+                wgrad_gemm_accum = \
+                    fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp32
+            else:
+                wgrad_gemm_accum = \
+                    fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp16
+        if hasattr(weight, 'main_grad'):
+            grad_weight = None
+        else:
+            grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            hidden_chunk = hidden_2d[start:end]
+
+            # Recompute the softmax of the chunk from the saved logsumexp.
+            logits = torch.matmul(hidden_chunk, weight.t()).float()
+            grad_logits = torch.exp(logits - lse[start:end].unsqueeze(dim=-1))
+            arange_1d = torch.arange(start=0,
+                                     end=end - start,
+                                     device=grad_logits.device)
+            grad_logits[arange_1d, masked_target_1d[start:end]] -= (
+                1.0 - target_mask[start:end].float())
+            grad_logits.mul_(grad_output_1d[start:end].unsqueeze(dim=-1))
+            grad_logits = grad_logits.to(hidden.dtype)
+
+            grad_hidden[start:end] = torch.matmul(grad_logits, weight)
+            if wgrad_gemm_accum is not None:
+                wgrad_gemm_accum(hidden_chunk.contiguous(), grad_logits,
+                                 weight.main_grad)
+            elif grad_weight is None:
+                weight.main_grad.add_(
+                    torch.matmul(grad_logits.t(), hidden_chunk))
+            else:
+                grad_weight.add_(torch.matmul(grad_logits.t(), hidden_chunk))
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden.view_as(hidden), grad_weight, None, None, None
+
+
+def fused_vocab_parallel_logits_cross_entropy(lm_output,
+                                              logit_weights,
+                                              target,
+                                              sequence_parallel,
+                                              chunk_size=1024,
+                                              gradient_accumulation_fusion=False):
+    """
+    Computes the vocab parallel cross entropy directly from the language model output.
+
+    The logits are produced and consumed chunk by chunk, so the full
+    [sequence_length, batch_size, vocab_size/num_parallel_ranks] logits tensor is never
+    materialized. The backward pass recomputes the logits of each chunk.
+
+    Args:
+        lm_output (torch.Tensor): The language model output of shape [sequence_length, batch_size, hidden_size].
+        logit_weights (torch.Tensor): The logit weights of shape [vocab_size/num_parallel_ranks, hidden_size].
+        target (torch.Tensor): The contiguous target tensor of shape [sequence_length, batch_size].
+        sequence_parallel (bool): Whether lm_output is split along the sequence dimension.
+        chunk_size (int, optional): The number of tokens per chunk. Defaults to 1024.
+        gradient_accumulation_fusion (bool, optional): Whether to accumulate the weight gradient
+            into logit_weights.main_grad with the fused_weight_gradient_mlp_cuda kernels.
+            Without it the gradient still goes into main_grad when the weight has one.
+            Defaults to False.
+
+    Returns:
+        torch.Tensor: The fp32 loss tensor of shape [sequence_length, batch_size].
+    """
+    if gradient_accumulation_fusion and not _grad_accum_fusion_available:
+        raise RuntimeError(
+            'fused_vocab_parallel_logits_cross_entropy was called with '
+            'gradient_accumulation_fusion set to True but the custom CUDA '
+            'extension fused_weight_gradient_mlp_cuda module is not found. '
+            'To use gradient_accumulation_fusion you must install APEX with '
+            '--cpp_ext and --cuda_ext.')
+
+    if sequence_parallel:
+        input_parallel = tensor_parallel.gather_from_sequence_parallel_region(
+            lm_output, tensor_parallel_output_grad=True)
+    else:
+        input_parallel = tensor_parallel.copy_to_tensor_model_parallel_region(
+            lm_output)
+
+    return _FusedVocabParallelLogitsCrossEntropy.apply(
+        input_parallel, logit_weights, target, chunk_size,
+        gradient_accumulation_fusion)
+
+
+if custom_op is not None:
+    # Forward only, used by megatron_patch.compile.fused_ce_pass to replace the
+    # logits projection followed by the cross entropy in graphs without backward.
+    @custom_op('megatron::fused_logits_ce', mutates_args=())
+    def _fused_logits_ce_op(hidden: torch.Tensor, weight: torch.Tensor,
+                            target: torch.Tensor) -> torch.Tensor:
+        return _fused_logits_cross_entropy_forward(hidden, weight, target,
+                                                   1024)[0]
+
+    @_fused_logits_ce_op.register_fake
+    def _(hidden, weight, target):
+        return target.new_empty(target.shape, dtype=torch.float32)
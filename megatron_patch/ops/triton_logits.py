@@ -0,0 +1,171 @@
+# Copyright (c) 2023 Alibaba PAI and Nvidia Megatron-LM Team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from typing import Optional
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+try:
+    from torch.library import custom_op
+except ImportError:
+    custom_op = None
+
+# Below this number of logits the cuBLAS path is used.
+TRITON_LM_LOGITS_MIN_NUMEL = 1 << 22
+
+if triton is not None:
+
+    @triton.autotune(
+        configs=[
+            triton.Config(
+                {
+                    'BLOCK_M': block_m,
+                    'BLOCK_N': block_n,
+                    'BLOCK_K': 64,
+                    'GROUP_M': 8
+                },
+                num_stages=3,
+                num_warps=8 if block_n == 256 else 4)
+            for block_m in (16, 32, 64) for block_n in (64, 128, 256)
+        ],
+        # M is the token count, it is bucketed so variable prompt lengths do
+        # not re-run the autotuning at every prefill.
+        key=['M_BUCKET', 'N', 'K'],
+    )
+    @triton.jit
+    def fused_logits_kernel(hidden_ptr, weight_ptr, out_ptr, M, N, K,
+                            M_BUCKET, stride_hm, stride_hk, stride_wn,
+                            stride_wk, stride_om, stride_on,
+                            BLOCK_M: tl.constexpr,
+                            BLOCK_N: tl.constexpr, BLOCK_K: tl.constexpr,
+                            GROUP_M: tl.constexpr):
+        """Computes out = hidden @ weight.T, one [BLOCK_M, BLOCK_N] tile per program."""
+        pid = tl.program_id(axis=0)
+        num_pid_m = tl.cdiv(M, BLOCK_M)
+        num_pid_n = tl.cdiv(N, BLOCK_N)
+        # Programs are ordered in groups of GROUP_M rows, so the weight tiles
+        # loaded by a group are reused from L2 by its neighbours.
+        num_pid_in_group = GROUP_M * num_pid_n
+        group_id = pid // num_pid_in_group
+        first_pid_m = group_id * GROUP_M
+        group_size_m = tl.minimum(num_pid_m - first_pid_m, GROUP_M)
+        pid_m = first_pid_m + ((pid % num_pid_in_group) % group_size_m)
+        pid_n = (pid % num_pid_in_group) // group_size_m
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_k = tl.arange(0, BLOCK_K)
+        hidden_ptrs = hidden_ptr + offs_m[:, None] * stride_hm + \
+            offs_k[None, :] * stride_hk
+        weight_ptrs = weight_ptr + offs_k[:, None] * stride_wk + \
+            offs_n[None, :] * stride_wn
+
+        acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+        for k in range(0, tl.cdiv(K, BLOCK_K)):
+            k_mask = offs_k < K - k * BLOCK_K
+            hidden = tl.load(hidden_ptrs,
+                             mask=(offs_m[:, None] < M) & k_mask[None, :],
+                             other=0.0)
+            weight = tl.load(weight_ptrs,
+                             mask=k_mask[:, None] & (offs_n[None, :] < N),
+                             other=0.0)
+            acc += tl.dot(hidden, weight)
+            hidden_ptrs += BLOCK_K * stride_hk
+            weight_ptrs += BLOCK_K * stride_wk
+
+        out_ptrs = out_ptr + offs_m[:, None] * stride_om + \
+            offs_n[None, :] * stride_on
+        tl.store(out_ptrs,
+                 acc.to(out_ptr.dtype.element_ty),
+                 mask=(offs_m[:, None] < M) & (offs_n[None, :] < N))
+
+
+def _triton_lm_logits(hidden, weight):
+    hidden_2d = hidden.reshape(-1, hidden.size()[-1])
+    M, K = hidden_2d.size()
+    N = weight.size()[0]
+    out = torch.empty((M, N), dtype=hidden.dtype, device=hidden.device)
+
+    def grid(meta):
+        return (triton.cdiv(M, meta['BLOCK_M']) *
+                triton.cdiv(N, meta['BLOCK_N']), )
+
+    fused_logits_kernel[grid](hidden_2d, weight, out, M, N, K,
+                              triton.next_power_of_2(M),
+                              hidden_2d.stride(0), hidden_2d.stride(1),
+                              weight.stride(0), weight.stride(1),
+                              out.stride(0), out.stride(1))
+    return out.view(*hidden.size()[:-1], N)
+
+
+if triton is not None and custom_op is not None:
+
+    @custom_op('megatron::triton_lm_logits', mutates_args=())
+    def _triton_lm_logits_op(hidden: torch.Tensor,
+                             weight: torch.Tensor) -> torch.Tensor:
+        return _triton_lm_logits(hidden, weight)
+
+    @_triton_lm_logits_op.register_fake
+    def _(hidden, weight):
+        return hidden.new_empty((*hidden.size()[:-1], weight.size()[0]))
+
+
+def use_triton_lm_logits(input_: torch.Tensor,
+                         weight: torch.Tensor,
+                         bias: Optional[torch.Tensor] = None) -> bool:
+    """
+    Returns whether the Triton kernel should compute these logits.
+
+    The kernel has no backward, so it is only used when autograd is disabled. It is
+    restricted to fp16 and bf16, since tl.dot would compute fp32 inputs in TF32 and
+    lose precision against cuBLAS.
+
+    Args:
+        input_ (torch.Tensor): The hidden states of shape [..., hidden_size].
+        weight (torch.Tensor): The vocab shard of the logit weights of shape [vocab_size/num_parallel_ranks, hidden_size].
+        bias (torch.Tensor, optional): The bias tensor. Defaults to None.
+
+    Returns:
+        bool: True if the Triton kernel applies.
+    """
+    return triton is not None and bias is None and \
+        not torch.is_grad_enabled() and input_.is_cuda and \
+        input_.dtype in (torch.float16, torch.bfloat16) and \
+        weight.dtype == input_.dtype and \
+        input_.numel() // input_.size()[-1] * weight.size()[0] >= \
+        TRITON_LM_LOGITS_MIN_NUMEL
+
+
+def triton_lm_logits(input_: torch.Tensor,
+                     weight: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the logits of a vocab shard with the Triton kernel.
+
+    Args:
+        input_ (torch.Tensor): The hidden states of shape [..., hidden_size].
+        weight (torch.Tensor): The vocab shard of the logit weights of shape [vocab_size/num_parallel_ranks, hidden_size].
+
+    Returns:
+        torch.Tensor: The logits of shape [..., vocab_size/num_parallel_ranks].
+    """
+    if custom_op is not None:
+        return torch.ops.megatron.triton_lm_logits(input_, weight)
+    return _triton_lm_logits(input_, weight)